@@ -2,10 +2,28 @@ import osmnx as ox
 import geopandas as gpd
 import networkit as nk
 import networkx as nx
+import numpy as np
+from scipy.spatial import cKDTree
 from typing import Tuple, Dict
+import os
+import re
 
-def load_geographic_data(place: str) -> Tuple[nk.Graph, gpd.GeoDataFrame, Dict[str, list]]:
-    """Load street network and POIs, mapping POIs to nearest NetworKit node IDs."""
+# (OSM key, value) of each POI category
+POI_TAGS = [
+    (('amenity', 'school'), 'schools'),
+    (('office', 'yes'), 'offices'),
+    (('shop', 'yes'), 'shops'),
+    (('leisure', 'park'), 'parks'),
+    (('amenity', 'restaurant'), 'restaurants'),
+    (('amenity', 'cafe'), 'cafes'),
+    (('tourism', 'hotel'), 'hotels')
+]
+
+def load_geographic_data(place: str) -> Tuple[nk.Graph, gpd.GeoDataFrame, Dict[str, list], np.ndarray]:
+    """Load street network and POIs, mapping POIs to nearest NetworKit node IDs.
+
+    Also returns the node coordinates as a float64[N_nodes, 2] array indexed by NetworKit ID.
+    """
     # Step 1: Load OSM graph as NetworkX
     graph_nx = ox.graph_from_place(place, network_type='drive')
     graph_nx = nx.Graph(graph_nx)
@@ -27,24 +45,31 @@ def load_geographic_data(place: str) -> Tuple[nk.Graph, gpd.GeoDataFrame, Dict[s
     nodes_gdf = nodes_gdf.loc[nx_id_to_nk_id.keys()]  # Keep only nodes in mapping
     nodes_gdf.index = nodes_gdf.index.map(nx_id_to_nk_id)  # Reindex to NetworKit IDs
     nodes_gdf.sort_index(inplace=True)
+    node_xy = np.ascontiguousarray(np.column_stack([nodes_gdf.geometry.x.values, nodes_gdf.geometry.y.values]))
+    node_tree = cKDTree(node_xy)
     # Step 6: Extract POIs and convert them to NetworKit node IDs
+    features = load_features(place)
+    centroids = features.geometry.centroid  # A point's centroid is the point itself
+    _, feature_nodes = node_tree.query(np.column_stack([centroids.x.values, centroids.y.values]), workers=-1)
     pois_nk = {}
-    for tag, key in [
-        ({'amenity': 'school'}, 'schools'),
-        ({'office': 'yes'}, 'offices'),
-        ({'shop': 'yes'}, 'shops'),
-        ({'leisure': 'park'}, 'parks'),
-        ({'amenity': 'restaurant'}, 'restaurants'),
-        ({'amenity': 'cafe'}, 'cafes'),
-        ({'tourism': 'hotel'}, 'hotels')
-    ]:
-        gdf = ox.features_from_place(place, tag)
-        if not gdf.empty:
-            coords = [(row.geometry.centroid.x, row.geometry.centroid.y) if row.geometry.type != 'Point' 
-                      else (row.geometry.x, row.geometry.y) for _, row in gdf.iterrows()]
-            poi_nodes_nx = [ox.distance.nearest_nodes(graph_nx, x, y) for x, y in coords]
-            poi_nodes_nk = [nx_id_to_nk_id[nx_id] for nx_id in poi_nodes_nx if nx_id in nx_id_to_nk_id]
-            pois_nk[key] = list(set(poi_nodes_nk))
+    for (column, value), key in POI_TAGS:
+        if column in features:
+            mask = (features[column] == value).to_numpy()
+            pois_nk[key] = np.unique(feature_nodes[mask]).tolist()  # Tree rows are NetworKit IDs
         else:
             pois_nk[key] = []
-    return graph_nk, nodes_gdf, pois_nk
+    return graph_nk, nodes_gdf, pois_nk, node_xy
+
+def load_features(place: str) -> gpd.GeoDataFrame:
+    """Fetch all POI features of place in one Overpass query, cached as parquet per place."""
+    cache_path = os.path.join(ox.settings.cache_folder, re.sub(r'\W+', '_', place).strip('_') + '_pois.parquet')
+    if os.path.exists(cache_path):
+        return gpd.read_parquet(cache_path)
+    tags: Dict[str, list] = {}
+    for (column, value), _ in POI_TAGS:
+        tags.setdefault(column, []).append(value)
+    gdf = ox.features_from_place(place, tags)
+    gdf = gdf[[column for column in tags if column in gdf] + ['geometry']].reset_index(drop=True)
+    os.makedirs(ox.settings.cache_folder, exist_ok=True)
+    gdf.to_parquet(cache_path)
+    return gdf
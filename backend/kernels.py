@@ -0,0 +1,105 @@
+import warnings
+import numpy as np
+from typing import Tuple
+
+try:
+    from numba import njit, prange
+except ImportError:  # Run the kernels as plain Python when Numba is not installed
+    warnings.warn("Numba is not installed; agent kernels will run as interpreted Python", RuntimeWarning)
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+    prange = range
+
+# Integer codes of the SEIRD states stored in DiseaseSpreadModel.state
+STATES = 'SEIRD'
+S, E, I, R, D = range(len(STATES))
+
+# Age-based roles, assigned once per agent
+CHILD, STUDENT, WORKER, ELDER = range(4)
+# Columns of DiseaseSpreadModel.routine holding each agent's routine destinations
+HOME, SCHOOL, WORK = range(3)
+# Bits of the routine phase of a step
+WEEKDAY, SCHOOL_HOURS, WORK_HOURS = 1, 2, 4
+
+def routine_tables() -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Tabulate the daily routine so destination choice is a lookup instead of a branch tree.
+
+    Returns the phase of every hour of the week, the routine destination column
+    for each (role, phase) and the chance of going to a leisure POI instead.
+    """
+    hours = np.arange(7 * 24)
+    week_phase = (WEEKDAY * (hours // 24 < 5) | SCHOOL_HOURS * ((8 <= hours % 24) & (hours % 24 < 15))
+                  | WORK_HOURS * ((8 <= hours % 24) & (hours % 24 < 17))).astype(np.int64)
+    target = np.full((4, 8), HOME, dtype=np.int64)
+    leisure_chance = np.zeros((4, 8), dtype=np.float64)
+    for phase in range(8):
+        if phase & WEEKDAY:
+            if phase & SCHOOL_HOURS:
+                target[STUDENT, phase] = SCHOOL
+            if phase & WORK_HOURS:
+                target[WORKER, phase] = WORK
+            leisure_chance[CHILD, phase] = leisure_chance[ELDER, phase] = 0.5  # Retirees or young children
+        else:  # Weekend
+            leisure_chance[:, phase] = 0.3
+    return week_phase, target, leisure_chance
+
+WEEK_PHASE, ROUTINE_TARGET, LEISURE_CHANCE = routine_tables()
+
+@njit(cache=True)
+def choose_destination(phase: int, state: int, role: int, routine: np.ndarray,
+                       leisure_pois: np.ndarray, u: np.ndarray) -> int:
+    """Pick a new destination based on routine phase, role, and health status.
+
+    u holds the agent's uniform draws for this step; columns 1-3 are used here.
+    """
+    # Infected agents stay home with 50% probability
+    if state == I and u[1] < 0.5:
+        return routine[HOME]
+    if len(leisure_pois) and u[2] < LEISURE_CHANCE[role, phase]:
+        return leisure_pois[int(u[3] * len(leisure_pois))]
+    return routine[ROUTINE_TARGET[role, phase]]
+
+@njit(parallel=True, cache=True)
+def update_agents(phase: int, latent_period: int, recovery_period: int, death_rate: float,
+                  state: np.ndarray, latent_timer: np.ndarray, infection_timer: np.ndarray, role: np.ndarray,
+                  routine: np.ndarray, leisure_pois: np.ndarray, current_node: np.ndarray,
+                  destination: np.ndarray, alive: np.ndarray, u: np.ndarray):
+    """Advance SEIRD timers and re-plan agents that have reached their destination.
+
+    Agents that die are cleared in alive instead of being removed from the model.
+    u is a float[N, 4] array of uniform draws for this step, one row per agent.
+    """
+    for i in prange(state.shape[0]):
+        if state[i] == E:
+            latent_timer[i] += 1
+            if latent_timer[i] >= latent_period:
+                state[i] = I
+                latent_timer[i] = 0
+                infection_timer[i] = 0
+        elif state[i] == I:
+            infection_timer[i] += 1
+            if infection_timer[i] >= recovery_period:
+                if u[i, 0] > death_rate:
+                    state[i] = R
+                else:
+                    state[i] = D
+                    alive[i] = False
+
+        if alive[i] and current_node[i] == destination[i]:
+            destination[i] = choose_destination(phase, state[i], role[i], routine[i], leisure_pois, u[i])
+
+@njit(parallel=True, cache=True)
+def move_agents(alive: np.ndarray, current_node: np.ndarray, destination: np.ndarray,
+                dest_slot: np.ndarray, pred_table: np.ndarray):
+    """Move every travelling agent one hop along its destination's shortest path tree."""
+    for i in prange(alive.shape[0]):
+        if not alive[i] or current_node[i] == destination[i]:
+            continue
+        node = pred_table[dest_slot[destination[i]], current_node[i]]
+        if node < 0:  # Destination unreachable, re-plan on the next step
+            destination[i] = current_node[i]
+        else:
+            current_node[i] = node
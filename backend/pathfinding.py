@@ -1,16 +1,18 @@
 import networkit as nk
-from typing import List
+import numpy as np
 
-def compute_path(graph: nk.Graph, start: int, end: int) -> List[int]:
-    """Compute shortest path between two nodes using NetworkIt's Dijkstra."""
-    if not (0 <= start < graph.numberOfNodes()):
-        print("Invalid start node")
-        return []
+def shortest_path_tree(graph: nk.Graph, target: int) -> np.ndarray:
+    """Compute the predecessor of every node on its shortest path to target.
 
-    if not (0 <= end < graph.numberOfNodes()):
-        print("Invalid end node")
-        return []
-    dijkstra = nk.distance.Dijkstra(graph, start,storePaths=True)
+    The street graph is undirected, so a single Dijkstra run from target gives
+    the route from any node towards it. Unreachable nodes are marked with -1.
+    """
+    dijkstra = nk.distance.Dijkstra(graph, target, storePaths=True)
     dijkstra.run()
-    path = dijkstra.getPath(end)
-    return list(path) if path else []
\ No newline at end of file
+    pred = np.full(graph.numberOfNodes(), -1, dtype=np.int32)
+    for node in range(graph.numberOfNodes()):
+        preds = dijkstra.getPredecessors(node)
+        if preds:
+            pred[node] = preds[0]
+    pred[target] = target
+    return pred
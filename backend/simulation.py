@@ -1,176 +1,281 @@
 from mesa import Model
 from mesa_geo import GeoSpace, GeoAgent
-from mesa.time import RandomActivation
-from scipy.spatial import KDTree
-from typing import List, Tuple, Dict, Optional
-import random
+from scipy.spatial import cKDTree
+from shapely.geometry import Point
+from typing import List, Tuple, Optional
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from data_loader import load_geographic_data
-from pathfinding import compute_path
+from pathfinding import shortest_path_tree
+from kernels import (STATES, S, E, I, CHILD, STUDENT, WORKER, ELDER, SCHOOL, WORK, WEEK_PHASE,
+                     update_agents, move_agents)
+
+# Number of shortest path trees kept before the least recently used ones are evicted
+MAX_PATH_TREES = 2048
+
+# Up to this many infected-susceptible pairs a dense distance matrix is cheaper than building a KD-tree;
+# the largest size measured at which brute force won for every shape
+BRUTE_FORCE_MAX_PAIRS = 1024
+
+# Infected agents per thread-pool task when a contact search is fanned out
+CONTACT_CHUNK = 256
+contact_pool = ThreadPoolExecutor()
+
+def find_contacts(inf_xy: np.ndarray, sus_xy: np.ndarray, radius: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the (infected, susceptible) row pairs that lie within radius of each other."""
+    if len(inf_xy) * len(sus_xy) <= BRUTE_FORCE_MAX_PAIRS:
+        diff = inf_xy[:, None, :] - sus_xy[None, :, :]
+        return np.nonzero(np.einsum('ijk,ijk->ij', diff, diff) <= radius * radius)
+
+    # The tree is rebuilt every step, so skip the balancing work that only pays off for long-lived trees
+    tree = cKDTree(sus_xy, leafsize=32, balanced_tree=False, compact_nodes=False)
+    if len(inf_xy) <= CONTACT_CHUNK:
+        return query_contacts(tree, inf_xy, radius, 0, workers=-1)
+
+    # cKDTree releases the GIL while querying, so chunks query in parallel while
+    # other threads flatten their results
+    parts = list(contact_pool.map(
+        lambda start: query_contacts(tree, inf_xy[start:start + CONTACT_CHUNK], radius, start),
+        range(0, len(inf_xy), CONTACT_CHUNK)
+    ))
+    return np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts])
+
+def query_contacts(tree: cKDTree, inf_xy: np.ndarray, radius: float, offset: int,
+                   workers: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+    """Query tree around each of inf_xy, whose rows start at offset, and return flat contact pairs."""
+    neighbours = tree.query_ball_point(inf_xy, r=radius, workers=workers, return_sorted=False)
+
+    # Flatten the ragged neighbour lists into (infected, susceptible) pairs
+    counts = np.fromiter(map(len, neighbours), dtype=np.intp, count=len(neighbours))
+    inf_local = np.repeat(np.arange(offset, offset + len(inf_xy)), counts)
+    sus_local = np.fromiter(itertools.chain.from_iterable(neighbours), dtype=np.intp, count=counts.sum())
+    return inf_local, sus_local
 
 class Person(GeoAgent):
-    """Agent representing a person with SEIRD state and age-based routine."""
-    def __init__(self, model: Model, geometry, home: int, work: Optional[int], 
+    """Agent representing a person with SEIRD state and age-based routine.
+
+    Mutable state lives in the model's SoA arrays at row idx and is advanced by
+    the kernels in kernels.py, so the agent itself is a Mesa-facing view of it.
+    """
+    def __init__(self, model: Model, idx: int, geometry, home: int, work: Optional[int], 
                  school: Optional[int], age: float,crs):
+        self.idx: int = idx  # Row of this agent in the model's SoA arrays, needed by the geometry setter
         super().__init__(model, geometry,crs)
-        self.state: str = 'S'  # S, E, I, R, D
         self.age: float = age
         self.home: int = home
         self.work: Optional[int] = work
         self.school: Optional[int] = school
-        self.current_destination: int = home
-        self.path: List[int] = []
-        self.latent_timer: int = 0
-        self.infection_timer: int = 0
-        self.current_node: int = home
 
-    def step(self):
-        """Update agent position and state."""
-        # Update state
-        if self.state == 'E':
-            self.latent_timer += 1
-            if self.latent_timer >= self.model.latent_period:
-                self.state = 'I'
-                self.latent_timer = 0
-                self.infection_timer = 0
-        elif self.state == 'I':
-            self.infection_timer += 1
-            if self.infection_timer >= self.model.recovery_period:
-                self.state = 'R' if random.random() > self.model.death_rate else 'D'
-        
-        # Update position
-        if not self.path:
-            self.update_destination()
-            path_key = (self.current_node, self.current_destination)
-            if path_key in self.model.path_cache:
-                self.path = self.model.path_cache[path_key]
-            else:
-                self.path = compute_path(self.model.graph, self.current_node, self.current_destination)
-                self.model.path_cache[path_key] = self.path
-        if self.path:
-            self.current_node = self.path.pop(0)
-            self.geometry = self.model.nodes.loc[self.current_node].geometry
-
-    def update_destination(self):
-        """Set new destination based on routine, age, and health status."""
-        day = self.model.schedule.steps // 24 % 7
-        hour = self.model.schedule.steps % 24
-        is_weekday = day < 5
-
-        # Infected agents stay home with 50% probability
-        if self.state == 'I' and random.random() < 0.5:
-            self.current_destination = self.home
-            return
+    @property
+    def state(self) -> str:
+        return STATES[self.model.state[self.idx]]
 
-        if is_weekday:
-            if 5 <= self.age < 18 and 8 <= hour < 15:  # School hours
-                self.current_destination = self.school if self.school else self.home
-            elif 18 <= self.age < 65 and 8 <= hour < 17:  # Work hours
-                self.current_destination = self.work if self.work else self.home
-            elif self.age >= 65 or self.age < 5:  # Retirees or young children
-                if random.random() < 0.5:  # 50% chance for leisure
-                    self.current_destination = random.choice(self.model.leisure_pois) if self.model.leisure_pois else self.home
-                else:
-                    self.current_destination = self.home
-            else:
-                self.current_destination = self.home
-        else:  # Weekend
-            if random.random() < 0.3:  # 30% chance for leisure
-                self.current_destination = random.choice(self.model.leisure_pois) if self.model.leisure_pois else self.home
-            else:
-                self.current_destination = self.home
+    @state.setter
+    def state(self, value: str):
+        self.model.state[self.idx] = STATES.index(value)
+
+    @property
+    def current_node(self) -> int:
+        return int(self.model.current_node[self.idx])
+
+    @property
+    def geometry(self) -> Point:
+        """Current position, built on access since the model only tracks xy."""
+        return Point(self.model.xy[self.idx])
+
+    @geometry.setter
+    def geometry(self, value: Point):
+        self.model.xy[self.idx] = (value.x, value.y)
+
+class FastGeoSpace(GeoSpace):
+    """GeoSpace that keeps a plain agent list instead of mesa-geo's R-tree index.
+
+    Every agent moves every step, so maintaining the index would be pure overhead;
+    contact queries use find_contacts over the model's xy array instead.
+    """
+    def __init__(self, crs: str):
+        super().__init__(crs=crs)
+        self._people: List[Person] = []
+
+    @property
+    def agents(self) -> List[Person]:
+        return [a for a in self._people if a.model.alive[a.idx]]
+
+    def add_agents(self, agents):
+        if isinstance(agents, GeoAgent):
+            agents = [agents]
+        self._people.extend(agents)
+
+    def remove_agent(self, agent: Person):
+        agent.model.alive[agent.idx] = False
+
+# State code -> single-character label, for packing states into one string
+STATE_CHARS = np.frombuffer(STATES.encode('ascii'), dtype='S1')
 
 class DiseaseSpreadModel(Model):
     """Mesa model for SEIRD disease spread simulation."""
     def __init__(self, place: str, infection_prob: float, distance_threshold: float, num_agents: int,
                  latent_period: int = 120, recovery_period: int = 168, death_rate: float = 0.01,total_days=90, crs="EPSG:4326",):
         super().__init__()
-        self.graph, self.nodes, pois = load_geographic_data(place)
-        self.space = GeoSpace()
+        self.graph, self.nodes, pois, self.node_xy = load_geographic_data(place)
+        self.space = FastGeoSpace(crs)
         self.total_days = total_days
         self.progress = 0
-        self.schedule = RandomActivation(self)
         self.infection_prob = infection_prob
         self.distance_threshold = distance_threshold
         self.latent_period = latent_period
         self.recovery_period = recovery_period
         self.death_rate = death_rate
         self.infection_events: List[Tuple[int, int, int]] = []
-        self.path_cache: Dict[Tuple[int, int], List[int]] = {}
+        self.rng = np.random.Generator(np.random.SFC64())
+
+        # Shortest path trees, one row per destination; dest_slot maps a node to its row and
+        # slot_node back, tree_last_used holds the last step each row was needed for LRU eviction
+        self.pred_table = np.empty((64, self.graph.numberOfNodes()), dtype=np.int32)
+        self.dest_slot = np.full(self.graph.numberOfNodes(), -1, dtype=np.int32)
+        self.slot_node = np.full(len(self.pred_table), -1, dtype=np.int32)
+        self.tree_last_used = np.zeros(len(self.pred_table), dtype=np.int64)
+        self.num_trees = 0
 
         # Categorize POIs
         self.work_pois = list(set(pois['offices'] + pois['shops']))
         self.education_pois = list(set(pois['schools']))
         self.leisure_pois = list(set(pois['parks'] + pois['restaurants'] + pois['cafes'] + pois['shops']))
+        self.leisure_arr = np.array(self.leisure_pois, dtype=np.int32)
+
+        # Per-agent SoA arrays, indexed by Person.idx
+        self.xy = np.zeros((num_agents, 2), dtype=np.float64)
+        self.state = np.full(num_agents, S, dtype=np.uint8)
+        self.alive = np.ones(num_agents, dtype=np.bool_)  # Dead agents are masked out, never removed
+        self.ids = np.zeros(num_agents, dtype=np.int64)
+        self.age = np.zeros(num_agents, dtype=np.float64)
+        self.role = np.zeros(num_agents, dtype=np.uint8)
+        self.routine = np.zeros((num_agents, 3), dtype=np.int32)  # Home, school and work node
+        self.current_node = np.zeros(num_agents, dtype=np.int32)
+        self.destination = np.zeros(num_agents, dtype=np.int32)
+        self.latent_timer = np.zeros(num_agents, dtype=np.int32)
+        self.infection_timer = np.zeros(num_agents, dtype=np.int32)
 
-        # Initialize agents
+        # Initialize agents, drawing their homes, ages, schools and workplaces in bulk
+        homes = self.rng.choice(self.nodes.index.to_numpy(), num_agents).tolist()
+        ages = self.rng.uniform(0, 80, num_agents).tolist()
+        schools = self.rng.choice(self.education_pois, num_agents).tolist() if self.education_pois else homes
+        works = self.rng.choice(self.work_pois, num_agents).tolist() if self.work_pois else homes
         for i in range(num_agents):
-            home = random.choice(self.nodes.index)
-            age = random.uniform(0, 80)
+            home = homes[i]
+            age = ages[i]
             if 5 <= age < 18:
-                school = random.choice(self.education_pois) if self.education_pois else home
+                role = STUDENT
+                school = schools[i]
                 work = None
             elif 18 <= age < 65:
+                role = WORKER
                 school = None
-                work = random.choice(self.work_pois) if self.work_pois else home
+                work = works[i]
             else:
+                role = CHILD if age < 5 else ELDER
                 school = None
                 work = None
-            geometry = self.nodes.loc[home].geometry
-            agent = Person(self, geometry, home, work, school, age,crs)
+            self.xy[i] = self.node_xy[home]
+            agent = Person(self, i, Point(self.xy[i]), home, work, school, age,crs)
+            self.ids[i] = agent.unique_id
+            self.age[i] = age
+            self.role[i] = role
+            self.routine[i] = home
+            self.routine[i, SCHOOL] = school if school is not None else home
+            self.routine[i, WORK] = work if work is not None else home
+            self.current_node[i] = self.destination[i] = home
             if i < num_agents * 0.01:  # 1% initially infected
                 agent.state = 'I'
-            self.schedule.add(agent)
             self.space.add_agents(agent)
 
+        # Indices of susceptible agents and of agents in the course of the disease (E or I).
+        # Agents only leave S in check_infections, which maintains both instead of rescanning state.
+        self.sus_idx = np.flatnonzero(self.state == S)
+        self.active_idx = np.flatnonzero(self.state == I)
+
     def step(self):
         """Advance simulation by one step."""
-        self.schedule.step()
+        phase = WEEK_PHASE[(self.steps - 1) % len(WEEK_PHASE)]  # Mesa increments steps before calling step()
+        update_agents(phase, self.latent_period, self.recovery_period, self.death_rate,
+                      self.state, self.latent_timer, self.infection_timer, self.role,
+                      self.routine, self.leisure_arr, self.current_node, self.destination, self.alive,
+                      self.rng.random((len(self.state), 4), dtype=np.float32))
+        self.build_trees(self.destination[self.alive])
+        move_agents(self.alive, self.current_node, self.destination, self.dest_slot, self.pred_table)
+        self.xy = self.node_xy[self.current_node]
         self.check_infections()
-        for agent in self.schedule.agents[:]:
-            if agent.state == 'D':
-                self.schedule.remove(agent)
-                self.space.remove_agent(agent)
+
+    def build_trees(self, destinations: np.ndarray):
+        """Build shortest path trees for destinations that do not have one yet."""
+        slots = self.dest_slot[destinations]
+        self.tree_last_used[slots[slots >= 0]] = self.steps
+        for node in np.unique(destinations[slots < 0]):
+            slot = self.free_tree_slot()
+            self.pred_table[slot] = shortest_path_tree(self.graph, int(node))
+            self.dest_slot[node] = slot
+            self.slot_node[slot] = node
+            self.tree_last_used[slot] = self.steps
+
+    def free_tree_slot(self) -> int:
+        """Return an unused row of pred_table, evicting the least recently used tree once it is full.
+
+        Trees needed in the current step are never evicted; the table grows past
+        MAX_PATH_TREES instead if every row is in use.
+        """
+        if self.num_trees == len(self.pred_table):
+            lru = int(np.argmin(self.tree_last_used))
+            if len(self.pred_table) >= MAX_PATH_TREES and self.tree_last_used[lru] < self.steps:
+                self.dest_slot[self.slot_node[lru]] = -1
+                return lru
+            rows = len(self.pred_table)
+            extra = min(rows, MAX_PATH_TREES - rows) if rows < MAX_PATH_TREES else rows
+            self.pred_table = np.concatenate([self.pred_table, np.empty((extra, self.pred_table.shape[1]), np.int32)])
+            self.slot_node = np.concatenate([self.slot_node, np.full(extra, -1, dtype=np.int32)])
+            self.tree_last_used = np.concatenate([self.tree_last_used, np.zeros(extra, dtype=np.int64)])
+        self.num_trees += 1
+        return self.num_trees - 1
 
     def check_infections(self):
         """Check for infection events."""
-        infected = [a for a in self.schedule.agents if a.state == 'I']
-        susceptible = [a for a in self.schedule.agents if a.state == 'S']
-        if not infected or not susceptible:
+        active_state = self.state[self.active_idx]
+        self.active_idx = self.active_idx[(active_state == E) | (active_state == I)]
+        inf_idx = self.active_idx[self.state[self.active_idx] == I]
+        sus_idx = self.sus_idx
+        if not len(inf_idx) or not len(sus_idx):
             return
-        positions = [a.geometry.coords[0] for a in susceptible]
-        tree = KDTree(positions)
-        for inf in infected:
-            indices = tree.query_ball_point(inf.geometry.coords[0], self.distance_threshold)
-            for idx in indices:
-                sus = susceptible[idx]
-                if random.random() < self.infection_prob:
-                    sus.state = 'E'
-                    sus.latent_timer = 0
-                    self.infection_events.append((inf.unique_id, sus.unique_id, self.schedule.steps))
+        inf_local, sus_local = find_contacts(self.xy[inf_idx], self.xy[sus_idx], self.distance_threshold)
+        hits = self.rng.random(len(sus_local)) < self.infection_prob
+
+        # A susceptible reached by several infected agents is exposed only once
+        exposed, first = np.unique(sus_local[hits], return_index=True)
+        infectors = inf_local[hits][first]
+        # Susceptible agents never tick their latent timer, so it is already 0
+        self.state[sus_idx[exposed]] = E
+        self.sus_idx = np.delete(sus_idx, exposed)
+        self.active_idx = np.concatenate([self.active_idx, sus_idx[exposed]])
+        step = self.steps
+        self.infection_events.extend(
+            (inf_id, sus_id, step)
+            for inf_id, sus_id in zip(self.ids[inf_idx[infectors]].tolist(), self.ids[sus_idx[exposed]].tolist())
+        )
 
     def get_state(self) -> dict:
-        """Return current simulation state."""
-        features = [
-            {
-                "type": "Feature",
-                "geometry": {"type": "Point", "coordinates": a.geometry.coords[0]},
-                "properties": {
-                    "id": a.unique_id,
-                    "state": a.state,
-                    "age": a.age  # Added age to properties
-                }
-            }
-            for a in self.schedule.agents if a.state != 'D'
-        ]
-        seird_counts = {
-            'S': sum(1 for a in self.schedule.agents if a.state == 'S'),
-            'E': sum(1 for a in self.schedule.agents if a.state == 'E'),
-            'I': sum(1 for a in self.schedule.agents if a.state == 'I'),
-            'R': sum(1 for a in self.schedule.agents if a.state == 'R'),
-            'D': sum(1 for a in self.schedule.agents if a.state == 'D')
-        }
+        """Return current simulation state.
+
+        Living agents are packed column-wise (one list per property, states as a
+        single 'SEIRD' character string) so serialization stays in orjson's C path.
+        """
+        alive = self.alive
+        seird_counts = dict(zip(STATES, np.bincount(self.state, minlength=len(STATES)).tolist()))
         return {
-            "agents": {"type": "FeatureCollection", "features": features},
+            "agents": {
+                "ids": self.ids[alive].tolist(),
+                "coordinates": self.xy[alive].tolist(),
+                "states": STATE_CHARS[self.state[alive]].tobytes().decode('ascii'),
+                "ages": self.age[alive].tolist()
+            },
             "seird_counts": seird_counts,
-            "step": self.schedule.steps
-        }
\ No newline at end of file
+            "step": self.steps
+        }
@@ -1,4 +1,11 @@
-import type { SimulationParameters, BackendSimulationParameters, SimulationResponse, StepResponse } from "@/types/api"
+import type {
+  SimulationParameters,
+  BackendSimulationParameters,
+  SimulationResponse,
+  StepResponse,
+  AgentFeature,
+  PackedAgents,
+} from "@/types/api"
 
 const API_BASE_URL = process.env.NEXT_PUBLIC_API_URL || "http://localhost:8000"
 
@@ -17,6 +24,22 @@ function transformToBackendParams(params: SimulationParameters): BackendSimulati
   }
 }
 
+// Expand the backend's column-wise agent arrays into GeoJSON features
+function unpackAgents(agents: PackedAgents): StepResponse["agents"] {
+  return {
+    type: "FeatureCollection",
+    features: agents.ids.map((id, i) => ({
+      type: "Feature",
+      geometry: { type: "Point", coordinates: agents.coordinates[i] },
+      properties: {
+        id,
+        state: agents.states[i] as AgentFeature["properties"]["state"],
+        age: agents.ages[i],
+      },
+    })),
+  }
+}
+
 export async function initializeSimulation(params: SimulationParameters): Promise<SimulationResponse> {
   try {
     // Transform parameters to backend format
@@ -59,7 +82,7 @@ export async function getNextStep(): Promise<StepResponse> {
 
     // Ensure we have a properly formatted response with consistent SEIR counts
     return {
-      agents: data.agents || { type: "FeatureCollection", features: [] },
+      agents: data.agents ? unpackAgents(data.agents) : { type: "FeatureCollection", features: [] },
       seird_counts: data.seird_counts || { S: 0, E: 0, I: 0, R: 0, D: 0 },
       step: data.step || 0,
       day: data.day || 0,
@@ -50,6 +50,14 @@ export interface AgentFeature {
   }
 }
 
+// Agents as sent by the backend: one array per property, states packed into one string
+export interface PackedAgents {
+  ids: number[]
+  coordinates: [number, number][]
+  states: string
+  ages: number[]
+}
+
 // Updated to match the backend response format
 export interface StepResponse {
   agents?: {
@@ -3,17 +3,338 @@ Example Flask backend for the disease simulation
 """
 
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+from collections import OrderedDict
+from dataclasses import dataclass, fields
+from functools import wraps
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+import orjson
+from scipy.spatial import cKDTree
+import os
+import threading
 import uuid
 import time
-import random
 import math
 
+try:
+    from numba import njit, prange
+except ImportError:  # Run the agent kernel as plain Python when Numba is not installed
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+    prange = range
+
+try:
+    import cupy as cp
+except ImportError:  # Step every population on the CPU when CuPy is not installed
+    cp = None
+
+class ORJSONProvider(JSONProvider):
+    """JSON provider that encodes with orjson, which also handles NumPy arrays and scalars"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY),
+                                        mimetype='application/json')
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)  # jsonify and request.json go through orjson
 CORS(app)  # Enable CORS for all routes
 
-# In-memory storage for simulations
-simulations = {}
+# Agent status codes stored in AgentArrays.status
+SUSCEPTIBLE, EXPOSED, INFECTED, RECOVERED, DECEASED = range(5)
+STATUS_NAMES = ['susceptible', 'exposed', 'infected', 'recovered', 'deceased']
+GENDER_NAMES = ['male', 'female']
+AGE_GROUP_NAMES = ['0-9', '10-19', '20-29', '30-39', '40-49', '50-59', '60-69', '70-79', '80+']
+# Age group index of every age from 0 to 90; stats keep age groups by index and only use names in responses
+_AGE_LUT = np.clip(np.arange(91) // 10, 0, len(AGE_GROUP_NAMES) - 1).astype(np.int8)
+# One row of a simulation's history, preallocated for every day
+HISTORY_DTYPE = np.dtype([
+    ('day', 'i4'), ('new_infections', 'i4'), ('new_recoveries', 'i4'), ('new_deaths', 'i4'),
+    ('susceptible', 'i4'), ('exposed', 'i4'), ('infected', 'i4'), ('recovered', 'i4'), ('deceased', 'i4'),
+    ('r0', 'f4')
+])
+
+@dataclass
+class AgentArrays:
+    """Agent population stored as one NumPy array per attribute"""
+    status: np.ndarray         # int8 index into STATUS_NAMES
+    age: np.ndarray            # int8 age in years
+    gender: np.ndarray         # int8 index into GENDER_NAMES
+    x: np.ndarray              # float32 position
+    y: np.ndarray              # float32 position
+    infection_day: np.ndarray  # int32 day of infection, -1 if never infected
+    outcome_day: np.ndarray    # int32 day of recovery or death, -1 if neither
+    death_mult: np.ndarray     # float32 age-based multiplier of the fatality rate
+    infection_mult: np.ndarray # float32 multiplier of the infection probability, lower if vaccinated
+
+    def __len__(self):
+        return len(self.status)
+
+    def to_dicts(self, indices=None):
+        """Materialize the agents at the given indices (all agents by default) as JSON-ready dicts"""
+        if indices is None:
+            indices = np.arange(len(self))
+        agents = []
+        for i, status, x, y, age, gender, infection_day, outcome_day in zip(
+                indices.tolist(), self.status[indices].tolist(), self.x[indices].tolist(),
+                self.y[indices].tolist(), self.age[indices].tolist(), self.gender[indices].tolist(),
+                self.infection_day[indices].tolist(), self.outcome_day[indices].tolist()):
+            agent = {
+                'id': i,
+                'status': STATUS_NAMES[status],
+                'x': x,
+                'y': y,
+                'age': age,
+                'gender': GENDER_NAMES[gender]
+            }
+            if infection_day >= 0:
+                agent['infection_day'] = infection_day
+            if status == RECOVERED:
+                agent['recovery_day'] = outcome_day
+            elif status == DECEASED:
+                agent['deceased_day'] = outcome_day
+            agents.append(agent)
+        return agents
+
+class RedisSimulationStore:
+    """Dict-like simulation storage in Redis, so any worker can serve any simulation
+    
+    Agent arrays are stored as raw bytes in a hash and everything else as one JSON value.
+    Entries expire SIMULATION_TTL seconds after they were last saved.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def __contains__(self, simulation_id):
+        return self.client.exists(f'sim:{simulation_id}') > 0
+
+    def get(self, simulation_id, default=None):
+        # One round trip, so a simulation expiring between a membership check and the read can't raise
+        try:
+            return self[simulation_id]
+        except KeyError:
+            return default
+
+    def __getitem__(self, simulation_id):
+        meta, arrays = self.client.pipeline().get(f'sim:{simulation_id}').hgetall(f'sim:{simulation_id}:arrays').execute()
+        if meta is None:
+            raise KeyError(simulation_id)
+        simulation = orjson.loads(meta)
+        # Copy out of the bytes so the step can update the arrays in place
+        dtypes = {**simulation.pop('dtypes'), 'history': HISTORY_DTYPE}
+        arrays = {name.decode(): np.frombuffer(raw, dtype=dtypes[name.decode()]).copy() for name, raw in arrays.items()}
+        simulation['changed_this_tick'] = arrays.pop('changed_this_tick')
+        simulation['history'] = arrays.pop('history')
+        simulation['agents'] = self.load_agents(simulation_id, simulation, arrays, dtypes)
+        return simulation
+
+    def __setitem__(self, simulation_id, simulation):
+        agents = simulation['agents']
+        arrays = {
+            **self.save_agents(simulation_id, simulation),
+            'changed_this_tick': simulation['changed_this_tick'],
+            'history': simulation['history']
+        }
+        meta = {key: value for key, value in simulation.items() if key not in ('agents', 'changed_this_tick', 'history')}
+        meta['dtypes'] = {field.name: getattr(agents, field.name).dtype.str for field in fields(AgentArrays)}
+        meta['dtypes']['changed_this_tick'] = simulation['changed_this_tick'].dtype.str
+        meta['population_size'] = len(agents)
+        
+        pipe = self.client.pipeline()
+        pipe.setex(f'sim:{simulation_id}', SIMULATION_TTL,
+                   orjson.dumps(meta, option=orjson.OPT_SERIALIZE_NUMPY))
+        pipe.delete(f'sim:{simulation_id}:arrays')
+        pipe.hset(f'sim:{simulation_id}:arrays', mapping={name: array.tobytes() for name, array in arrays.items()})
+        pipe.expire(f'sim:{simulation_id}:arrays', SIMULATION_TTL)
+        pipe.execute()
+
+    def load_agents(self, simulation_id, simulation, arrays, dtypes):
+        """Build a simulation's agents from the arrays read out of its hash"""
+        return AgentArrays(**{field.name: arrays[field.name] for field in fields(AgentArrays)})
+
+    def save_agents(self, simulation_id, simulation):
+        """Pick the agent arrays to write into a simulation's hash"""
+        return {field.name: getattr(simulation['agents'], field.name) for field in fields(AgentArrays)}
+
+    def lock(self, simulation_id):
+        """Lock held by whichever worker is updating a simulation"""
+        return self.client.lock(f'sim:{simulation_id}:lock', timeout=SIMULATION_LOCK_TIMEOUT)
+
+class SharedMemorySimulationStore(RedisSimulationStore):
+    """Redis simulation storage whose agent arrays live in shared memory on this host
+    
+    Workers map a running simulation's agent arrays instead of copying them through Redis,
+    and the step updates them in place. Every new or reset population gets a fresh generation
+    of blocks; superseded, completed and expired generations are unlinked, and each worker
+    keeps only its MAX_MAPPED_GENERATIONS most recently used generations mapped. Only usable
+    when every worker runs on the same machine.
+    """
+
+    def __init__(self, client):
+        super().__init__(client)
+        self.mapped = OrderedDict()  # Generation -> {field: block} mapped by this process, oldest first
+        self.unclosed = []  # Unmapped blocks whose arrays were still in use when they were unmapped
+        self.mapping_lock = threading.RLock()  # Guards mapped and unclosed across this worker's request threads
+
+    def __setitem__(self, simulation_id, simulation):
+        super().__setitem__(simulation_id, simulation)
+        # Registered only once the simulation is in Redis, so a sweep never mistakes it for expired
+        if 'shm_generation' in simulation:
+            self.client.sadd(SHM_GENERATIONS_KEY, f"{simulation_id}:{simulation['shm_generation']}")
+
+    def load_agents(self, simulation_id, simulation, arrays, dtypes):
+        self.close_unused()
+        generation = simulation.get('shm_generation')
+        if generation is None:  # Completed simulations keep their final agents in Redis
+            return super().load_agents(simulation_id, simulation, arrays, dtypes)
+        try:
+            blocks = self.map_blocks(generation, simulation['population_size'], dtypes)
+        except FileNotFoundError:  # Unlinked by a reset or completion in another worker
+            raise KeyError(simulation_id)
+        # frombuffer holds the block's buffer export, so unmap can't close a block under live arrays
+        return AgentArrays(**{name: np.frombuffer(block.buf, dtype=dtypes[name], count=simulation['population_size'])
+                              for name, block in blocks.items()})
+
+    def save_agents(self, simulation_id, simulation):
+        agents = simulation['agents']
+        generation = simulation.get('shm_generation')
+        if simulation['status'] == 'completed':
+            # Finished simulations no longer step, so keep their final agents in Redis and free the blocks
+            if generation is not None:
+                del simulation['shm_generation']
+                self.unlink(simulation_id, generation)
+            return super().save_agents(simulation_id, simulation)
+        if generation is None:
+            # New or reset population; a reset supersedes the generation currently in Redis
+            previous = self.client.get(f'sim:{simulation_id}')
+            previous = previous and orjson.loads(previous).get('shm_generation')
+            if previous:
+                self.unlink(simulation_id, previous)
+            self.sweep()
+            
+            generation = simulation['shm_generation'] = uuid.uuid4().hex[:12]
+            dtypes = {field.name: getattr(agents, field.name).dtype for field in fields(AgentArrays)}
+            for name, block in self.map_blocks(generation, len(agents), dtypes, create=True).items():
+                np.frombuffer(block.buf, dtype=dtypes[name], count=len(agents))[:] = getattr(agents, name)
+        # Otherwise the agents were loaded from the blocks and the step already updated them in place
+        return {}
+
+    def map_blocks(self, generation, population_size, dtypes, create=False):
+        """Map, or create, the blocks holding a generation's agent arrays"""
+        with self.mapping_lock:
+            if generation in self.mapped:
+                self.mapped.move_to_end(generation)
+                return self.mapped[generation]
+            blocks = {}
+            for name, dtype in dtypes.items():
+                block = shared_memory.SharedMemory(name=f'sim-{generation}-{name}', create=create,
+                                                   size=max(population_size * np.dtype(dtype).itemsize, 1))
+                # The block belongs to the simulation, not to this worker, so don't unlink it when the worker exits
+                resource_tracker.unregister(block._name, 'shared_memory')
+                blocks[name] = block
+            self.mapped[generation] = blocks
+            while len(self.mapped) > MAX_MAPPED_GENERATIONS:
+                self.unmap(next(iter(self.mapped)))
+            return blocks
+
+    def unmap(self, generation):
+        """Close this process's mappings of a generation once no arrays use them"""
+        with self.mapping_lock:
+            self.unclosed.extend(self.mapped.pop(generation, {}).values())
+            self.close_unused()
+
+    def close_unused(self):
+        """Close the unmapped blocks whose arrays have since been released"""
+        with self.mapping_lock:
+            still_used = []
+            for block in self.unclosed:
+                try:
+                    block.close()
+                except BufferError:  # Another thread still holds arrays on it
+                    still_used.append(block)
+            self.unclosed = still_used
+
+    def unlink(self, simulation_id, generation):
+        """Remove a generation's blocks from the system; existing mappings stay valid until closed"""
+        self.unmap(generation)
+        for field in fields(AgentArrays):
+            try:
+                block = shared_memory.SharedMemory(name=f'sim-{generation}-{field.name}')
+            except FileNotFoundError:
+                continue
+            block.unlink()
+            block.close()
+        self.client.srem(SHM_GENERATIONS_KEY, f'{simulation_id}:{generation}')
+
+    def sweep(self):
+        """Unlink the generations of simulations that have expired from Redis"""
+        with self.mapping_lock:
+            live = set()
+            for member in self.client.smembers(SHM_GENERATIONS_KEY):
+                simulation_id, generation = member.decode().split(':')
+                if self.client.exists(f'sim:{simulation_id}'):
+                    live.add(generation)
+                else:
+                    self.unlink(simulation_id, generation)
+            for generation in [generation for generation in self.mapped if generation not in live]:
+                self.unmap(generation)
+
+# Seconds a simulation is kept in Redis after its last update
+SIMULATION_TTL = 3600
+# Seconds before a worker's lock on a simulation it is updating expires, should the worker die
+SIMULATION_LOCK_TIMEOUT = 60
+# Redis set of "<simulation id>:<generation>" for every generation of shared memory blocks
+SHM_GENERATIONS_KEY = 'shm:generations'
+# Shared memory generations each worker keeps mapped
+MAX_MAPPED_GENERATIONS = 8
+
+# Storage for simulations: Redis when REDIS_URL is set, with agent arrays in shared memory
+# if SHARED_MEMORY is also set, otherwise this process's memory
+if os.environ.get('REDIS_URL'):
+    import redis
+    store = SharedMemorySimulationStore if os.environ.get('SHARED_MEMORY') else RedisSimulationStore
+    simulations = store(redis.Redis.from_url(os.environ['REDIS_URL']))
+else:
+    simulations = {}
+
+# Locks for simulations kept in this process's memory, by simulation id
+simulation_locks = {}
+simulation_locks_lock = threading.Lock()
+
+def simulation_lock(simulation_id):
+    """Keep other threads, or workers for a simulation stored in Redis, from updating a simulation until this update is saved"""
+    if isinstance(simulations, RedisSimulationStore):
+        return simulations.lock(simulation_id)
+    with simulation_locks_lock:
+        return simulation_locks.setdefault(simulation_id, threading.Lock())
+
+def updates_simulation(view):
+    """Run a view that loads, changes and saves a simulation under that simulation's lock"""
+    @wraps(view)
+    def locked_view(simulation_id):
+        with simulation_lock(simulation_id):
+            return view(simulation_id)
+    return locked_view
+
+# Number of agents returned by /next unless the client asks for another sample size
+DEFAULT_AGENT_SAMPLE = 500
+
+# Populations at least this large are stepped on the GPU when CuPy is available
+GPU_MIN_POPULATION = 1_000_000
+
+# Shared generator for drawing populations in bulk; SFC64 is faster than the default PCG64
+rng = np.random.Generator(np.random.SFC64())
 
 @app.route('/api/simulation/initialize', methods=['POST'])
 def initialize_simulation():
@@ -24,24 +345,7 @@ def initialize_simulation():
     simulation_id = str(uuid.uuid4())
     
     # Store simulation parameters and initial state
-    simulations[simulation_id] = {
-        'id': simulation_id,
-        'parameters': params,
-        'status': 'initializing',
-        'current_day': 0,
-        'total_days': params.get('simulationDays', 90),
-        'progress': 0,
-        'agents': generate_initial_agents(params),
-        'stats': calculate_initial_stats(params),
-        'history': [],
-        'last_updated': time.time()
-    }
-    
-    # Simulate initialization delay
-    time.sleep(1)
-    
-    # Update status to running
-    simulations[simulation_id]['status'] = 'running'
+    simulations[simulation_id] = create_simulation(simulation_id, params)
     
     return jsonify({
         'simulationId': simulation_id,
@@ -52,13 +356,13 @@ def initialize_simulation():
     })
 
 @app.route('/api/simulation/<simulation_id>/next', methods=['GET'])
+@updates_simulation
 def get_next_time_step(simulation_id):
     """Get the next time step for the simulation"""
-    if simulation_id not in simulations:
+    simulation = simulations.get(simulation_id)
+    if simulation is None:
         return jsonify({'error': 'Simulation not found'}), 404
     
-    simulation = simulations[simulation_id]
-    
     if simulation['status'] != 'running':
         return jsonify({'error': f'Simulation is {simulation["status"]}, not running'}), 400
     
@@ -66,81 +370,92 @@ def get_next_time_step(simulation_id):
     simulation['current_day'] += 1
     simulation['progress'] = (simulation['current_day'] / simulation['total_days']) * 100
     
-    # Generate the next time step data
-    time_step = generate_time_step(simulation)
+    # Generate the next time step data with a bounded sample of the agents
+    sample = request.args.get('sample', DEFAULT_AGENT_SAMPLE, type=int)
+    time_step = generate_time_step(simulation, sample)
     
-    # Store in history
-    simulation['history'].append(time_step)
+    # Store the day's aggregates in history
+    record_history(simulation['history'], time_step)
     simulation['last_updated'] = time.time()
     
     # Check if simulation is complete
     if simulation['current_day'] >= simulation['total_days']:
         simulation['status'] = 'completed'
+        with gpu_populations_lock:
+            gpu_populations.pop(simulation_id, None)
+    
+    simulations[simulation_id] = simulation
     
     return jsonify(time_step)
 
+@app.route('/api/simulation/<simulation_id>/delta', methods=['GET'])
+def get_time_step_delta(simulation_id):
+    """Get the agents whose status changed in the latest time step"""
+    simulation = simulations.get(simulation_id)
+    if simulation is None:
+        return jsonify({'error': 'Simulation not found'}), 404
+    
+    return jsonify({
+        'day': simulation['current_day'],
+        'agents': simulation['agents'].to_dicts(simulation['changed_this_tick'])
+    })
+
 @app.route('/api/simulation/<simulation_id>/pause', methods=['POST'])
+@updates_simulation
 def pause_simulation(simulation_id):
     """Pause the simulation"""
-    if simulation_id not in simulations:
+    simulation = simulations.get(simulation_id)
+    if simulation is None:
         return jsonify({'error': 'Simulation not found'}), 404
     
-    simulation = simulations[simulation_id]
-    
     if simulation['status'] == 'running':
         simulation['status'] = 'paused'
         simulation['last_updated'] = time.time()
+        simulations[simulation_id] = simulation
         return jsonify({'success': True})
     else:
         return jsonify({'error': f'Cannot pause simulation in {simulation["status"]} state'}), 400
 
 @app.route('/api/simulation/<simulation_id>/resume', methods=['POST'])
+@updates_simulation
 def resume_simulation(simulation_id):
     """Resume the simulation"""
-    if simulation_id not in simulations:
+    simulation = simulations.get(simulation_id)
+    if simulation is None:
         return jsonify({'error': 'Simulation not found'}), 404
     
-    simulation = simulations[simulation_id]
-    
     if simulation['status'] == 'paused':
         simulation['status'] = 'running'
         simulation['last_updated'] = time.time()
+        simulations[simulation_id] = simulation
         return jsonify({'success': True})
     else:
         return jsonify({'error': f'Cannot resume simulation in {simulation["status"]} state'}), 400
 
 @app.route('/api/simulation/<simulation_id>/reset', methods=['POST'])
+@updates_simulation
 def reset_simulation(simulation_id):
     """Reset the simulation"""
-    if simulation_id not in simulations:
+    simulation = simulations.get(simulation_id)
+    if simulation is None:
         return jsonify({'error': 'Simulation not found'}), 404
     
-    params = simulations[simulation_id]['parameters']
+    params = simulation['parameters']
     
     # Reset the simulation state
-    simulations[simulation_id] = {
-        'id': simulation_id,
-        'parameters': params,
-        'status': 'running',
-        'current_day': 0,
-        'total_days': params.get('simulationDays', 90),
-        'progress': 0,
-        'agents': generate_initial_agents(params),
-        'stats': calculate_initial_stats(params),
-        'history': [],
-        'last_updated': time.time()
-    }
+    simulations[simulation_id] = create_simulation(simulation_id, params)
+    with gpu_populations_lock:
+        gpu_populations.pop(simulation_id, None)
     
     return jsonify({'success': True})
 
 @app.route('/api/simulation/<simulation_id>/status', methods=['GET'])
 def get_simulation_status(simulation_id):
     """Get the current status of the simulation"""
-    if simulation_id not in simulations:
+    simulation = simulations.get(simulation_id)
+    if simulation is None:
         return jsonify({'error': 'Simulation not found'}), 404
     
-    simulation = simulations[simulation_id]
-    
     return jsonify({
         'simulationId': simulation_id,
         'status': simulation['status'],
@@ -150,139 +465,35 @@ def get_simulation_status(simulation_id):
     })
 
 # Helper functions
-def generate_initial_agents(params):
-    """Generate the initial agent population"""
-    population_size = params.get('populationSize', 10000)
-    initial_infected = params.get('initialInfected', 5)
-    
-    agents = []
-    
-    for i in range(population_size):
-        status = 'infected' if i < initial_infected else 'susceptible'
-        
-        # Random position in a 1000x1000 grid
-        x = random.uniform(0, 1000)
-        y = random.uniform(0, 1000)
-        
-        # Random age between 0 and 90
-        age = random.randint(0, 90)
-        
-        # Random gender
-        gender = 'male' if random.random() < 0.5 else 'female'
-        
-        agents.append({
-            'id': i,
-            'status': status,
-            'x': x,
-            'y': y,
-            'age': age,
-            'gender': gender
-        })
-    
-    return agents
-
-def calculate_initial_stats(params):
-    """Calculate initial population statistics"""
-    population_size = params.get('populationSize', 10000)
-    initial_infected = params.get('initialInfected', 5)
-    
-    # Initialize age groups
-    age_groups = {
-        '0-9': {'total': 0, 'susceptible': 0, 'exposed': 0, 'infected': 0, 'recovered': 0, 'deceased': 0},
-        '10-19': {'total': 0, 'susceptible': 0, 'exposed': 0, 'infected': 0, 'recovered': 0, 'deceased': 0},
-        '20-29': {'total': 0, 'susceptible': 0, 'exposed': 0, 'infected': 0, 'recovered': 0, 'deceased': 0},
-        '30-39': {'total': 0, 'susceptible': 0, 'exposed': 0, 'infected': 0, 'recovered': 0, 'deceased': 0},
-        '40-49': {'total': 0, 'susceptible': 0, 'exposed': 0, 'infected': 0, 'recovered': 0, 'deceased': 0},
-        '50-59': {'total': 0, 'susceptible': 0, 'exposed': 0, 'infected': 0, 'recovered': 0, 'deceased': 0},
-        '60-69': {'total': 0, 'susceptible': 0, 'exposed': 0, 'infected': 0, 'recovered': 0, 'deceased': 0},
-        '70-79': {'total': 0, 'susceptible': 0, 'exposed': 0, 'infected': 0, 'recovered': 0, 'deceased': 0},
-        '80+': {'total': 0, 'susceptible': 0, 'exposed': 0, 'infected': 0, 'recovered': 0, 'deceased': 0},
-    }
-    
-    # Distribute population across age groups
-    for i in range(population_size):
-        age = random.randint(0, 90)
-        gender = 'male' if random.random() < 0.5 else 'female'
-        status = 'infected' if i < initial_infected else 'susceptible'
-        
-        # Determine age group
-        age_group = get_age_group(age)
-        
-        # Update age group stats
-        age_groups[age_group]['total'] += 1
-        age_groups[age_group][status] += 1
-    
-    # Gender distribution
-    male_count = int(population_size * 0.5)
-    female_count = population_size - male_count
-    
-    # Distribute infected across genders
-    male_infected = min(initial_infected // 2, male_count)
-    female_infected = min(initial_infected - male_infected, female_count)
-    
-    gender_distribution = {
-        'male': {
-            'total': male_count,
-            'susceptible': male_count - male_infected,
-            'exposed': 0,
-            'infected': male_infected,
-            'recovered': 0,
-            'deceased': 0
-        },
-        'female': {
-            'total': female_count,
-            'susceptible': female_count - female_infected,
-            'exposed': 0,
-            'infected': female_infected,
-            'recovered': 0,
-            'deceased': 0
-        }
-    }
+def create_simulation(simulation_id, params):
+    """Build the stored state of a new simulation"""
+    agents = generate_initial_agents(params)
     
     return {
-        'susceptible': population_size - initial_infected,
-        'exposed': 0,
-        'infected': initial_infected,
-        'recovered': 0,
-        'deceased': 0,
-        'ageGroups': age_groups,
-        'genderDistribution': gender_distribution
+        'id': simulation_id,
+        'parameters': params,
+        'population_id': uuid.uuid4().hex,  # Changes on reset, so cached device copies can tell populations apart
+        'rates': calculate_rates(params),
+        'status': 'running',
+        'current_day': 0,
+        'total_days': params.get('simulationDays', 90),
+        'progress': 0,
+        'agents': agents,
+        'stats': calculate_initial_stats(params, agents),
+        'history': np.zeros(params.get('simulationDays', 90) + 1, dtype=HISTORY_DTYPE),
+        'changed_this_tick': np.empty(0, dtype=np.intp),
+        'last_updated': time.time()
     }
 
-def get_age_group(age):
-    """Get the age group for a given age"""
-    if age < 10:
-        return '0-9'
-    elif age < 20:
-        return '10-19'
-    elif age < 30:
-        return '20-29'
-    elif age < 40:
-        return '30-39'
-    elif age < 50:
-        return '40-49'
-    elif age < 60:
-        return '50-59'
-    elif age < 70:
-        return '60-69'
-    elif age < 80:
-        return '70-79'
-    else:
-        return '80+'
-
-def generate_time_step(simulation):
-    """Generate the next time step data based on the current state"""
-    current_day = simulation['current_day']
-    agents = simulation['agents']
-    stats = simulation['stats']
-    params = simulation['parameters']
-    
+def calculate_rates(params):
+    """Derive the disease rates that stay constant for the whole simulation"""
     # Simple SIR model parameters
     r0 = params.get('r0', 2.5)
     recovery_time = params.get('recoveryTime', 14)
     fatality_rate = params.get('fatalityRate', 2.1) / 100
     
     # Calculate transmission probability based on R0
+    # Chance that one infected agent within contact_radius infects a susceptible agent in a day
     transmission_prob = r0 / recovery_time / 10  # Simplified model
     
     # Apply interventions
@@ -295,102 +506,261 @@ def generate_time_step(simulation):
     transmission_prob *= (1 - mask_usage * 0.5)
     transmission_prob *= (1 - vaccination_rate * 0.8)
     
-    # Track changes for this time step
-    new_infections = 0
-    new_recoveries = 0
-    new_deaths = 0
+    return {
+        'r0': r0,
+        'recovery_time': recovery_time,
+        'fatality_rate': fatality_rate,
+        'transmission_prob': transmission_prob,
+        'contact_radius': params.get('contactRadius', 5.0)
+    }
+
+def generate_initial_agents(params):
+    """Generate the initial agent population"""
+    population_size = params.get('populationSize', 10000)
+    initial_infected = params.get('initialInfected', 5)
+    vaccination_rate = params.get('vaccinationRate', 0) / 100
     
-    # Update each agent
-    for agent in agents:
-        if agent['status'] == 'infected':
-            # Determine if agent recovers or dies
-            days_infected = current_day - agent.get('infection_day', 0)
-            
-            if days_infected >= recovery_time:
-                # Determine if agent dies based on fatality rate and age
-                death_prob = fatality_rate
-                
-                # Adjust death probability based on age
-                if agent['age'] > 70:
-                    death_prob *= 5
-                elif agent['age'] > 60:
-                    death_prob *= 3
-                elif agent['age'] > 50:
-                    death_prob *= 2
-                
-                if random.random() < death_prob:
-                    agent['status'] = 'deceased'
-                    agent['deceased_day'] = current_day
-                    new_deaths += 1
-                else:
-                    agent['status'] = 'recovered'
-                    agent['recovery_day'] = current_day
-                    new_recoveries += 1
-        
-        elif agent['status'] == 'susceptible':
-            # Check for new infections
-            infected_nearby = 0
-            
-            # Simplified infection model - random chance based on number of infected
-            infected_count = stats['infected']
-            infection_prob = transmission_prob * (infected_count / len(agents))
-            
-            # Adjust based on vaccination
-            if random.random() < vaccination_rate:
-                infection_prob *= 0.2  # 80% reduction in infection probability if vaccinated
-            
-            if random.random() < infection_prob:
-                agent['status'] = 'infected'
-                agent['infection_day'] = current_day
-                new_infections += 1
+    # Random age between 0 and 90
+    age = rng.integers(0, 91, population_size, dtype=np.int8)
+    
+    agents = AgentArrays(
+        status=np.full(population_size, SUSCEPTIBLE, dtype=np.int8),
+        age=age,
+        # Random gender
+        gender=rng.integers(0, 2, population_size, dtype=np.int8),
+        # Random position in a 1000x1000 grid
+        x=rng.uniform(0, 1000, population_size).astype(np.float32),
+        y=rng.uniform(0, 1000, population_size).astype(np.float32),
+        infection_day=np.full(population_size, -1, dtype=np.int32),
+        outcome_day=np.full(population_size, -1, dtype=np.int32),
+        # Older agents are more likely to die of the infection
+        death_mult=np.select([age > 70, age > 60, age > 50], [5, 3, 2], default=1).astype(np.float32),
+        # Vaccinated agents keep an 80% reduction in infection probability for the whole simulation
+        infection_mult=np.where(rng.random(population_size) < vaccination_rate, 0.2, 1.0).astype(np.float32)
+    )
+    
+    # Initially infected agents count as infected on day 0
+    agents.status[:initial_infected] = INFECTED
+    agents.infection_day[:initial_infected] = 0
+    
+    return agents
+
+def calculate_initial_stats(params, agents):
+    """Calculate initial population statistics from the generated agents"""
+    age_groups = count_by_status(_AGE_LUT[agents.age], agents.status, len(AGE_GROUP_NAMES))
+    gender_distribution = dict(zip(GENDER_NAMES, count_by_status(agents.gender, agents.status, len(GENDER_NAMES))))
+    status_counts = np.bincount(agents.status, minlength=len(STATUS_NAMES)).tolist()
+    
+    return {
+        **dict(zip(STATUS_NAMES, status_counts)),
+        'ageGroups': age_groups,
+        'genderDistribution': gender_distribution
+    }
+
+def count_by_status(group_idx, status, num_groups):
+    """Count agents per group and status as a list of {'total': ..., 'susceptible': ..., ...} per group index"""
+    counts = np.bincount(group_idx.astype(np.intp) * len(STATUS_NAMES) + status,
+                         minlength=num_groups * len(STATUS_NAMES))
+    return [{'total': sum(row), **dict(zip(STATUS_NAMES, row))}
+            for row in counts.reshape(num_groups, len(STATUS_NAMES)).tolist()]
+
+def serialize_stats(stats):
+    """Copy the stats for a response, labelling age groups by name"""
+    return {
+        **stats,
+        'ageGroups': {name: dict(group) for name, group in zip(AGE_GROUP_NAMES, stats['ageGroups'])},
+        'genderDistribution': {gender: dict(group) for gender, group in stats['genderDistribution'].items()}
+    }
+
+def generate_time_step(simulation, sample=DEFAULT_AGENT_SAMPLE):
+    """Generate the next time step data based on the current state, including up to sample agents"""
+    current_day = simulation['current_day']
+    agents = simulation['agents']
+    stats = simulation['stats']
+    rates = simulation['rates']
+    r0 = rates['r0']
+    recovery_time = rates['recovery_time']
+    
+    # Susceptible agents can be infected by the infected agents around them
+    infected_nearby = count_infected_nearby(agents, rates['contact_radius'])
+    if cp is not None and len(agents) >= GPU_MIN_POPULATION:
+        new_infections, new_recoveries, new_deaths, changed, old_status, status_counts = _step_agents_gpu(
+            simulation, infected_nearby, current_day, recovery_time, rates['fatality_rate'], rates['transmission_prob']
+        )
+    else:
+        previous_status = agents.status.copy()
+        new_infections, new_recoveries, new_deaths = _step_agents(
+            agents.status, agents.death_mult, agents.infection_mult, agents.infection_day, agents.outcome_day,
+            infected_nearby, current_day, recovery_time, rates['fatality_rate'], rates['transmission_prob']
+        )
+        changed = np.flatnonzero(agents.status != previous_status)
+        old_status = previous_status[changed]
+        status_counts = np.bincount(agents.status, minlength=len(STATUS_NAMES))
     
     # Update statistics
-    stats['susceptible'] -= new_infections
-    stats['infected'] += new_infections - new_recoveries - new_deaths
-    stats['recovered'] += new_recoveries
-    stats['deceased'] += new_deaths
+    stats.update(zip(STATUS_NAMES, status_counts.tolist()))
     
-    # Update age and gender statistics
-    update_demographic_stats(agents, stats)
+    # Update age and gender statistics for the agents that changed status today
+    apply_transitions(agents, stats, changed, old_status)
+    simulation['changed_this_tick'] = changed
     
     # Calculate effective R0 based on new infections
     effective_r0 = r0
     if stats['infected'] > 0:
         effective_r0 = (new_infections / stats['infected']) * recovery_time
     
+    # The full population stays server-side; changed agents are available from /delta
+    sampled = None
+    if sample < len(agents):
+        sampled = np.sort(rng.choice(len(agents), max(sample, 0), replace=False))
+    
     return {
         'day': current_day,
-        'agents': agents,
-        'stats': stats,
+        'agents': agents.to_dicts(sampled),
+        'stats': serialize_stats(stats),
         'r0': effective_r0,
         'newInfections': new_infections,
         'newRecoveries': new_recoveries,
         'newDeaths': new_deaths
     }
 
-def update_demographic_stats(agents, stats):
-    """Update age and gender statistics based on current agent states"""
-    # Reset age group counts
-    for age_group in stats['ageGroups']:
-        for status in ['susceptible', 'exposed', 'infected', 'recovered', 'deceased']:
-            stats['ageGroups'][age_group][status] = 0
-    
-    # Reset gender counts
-    for gender in ['male', 'female']:
-        for status in ['susceptible', 'exposed', 'infected', 'recovered', 'deceased']:
-            stats['genderDistribution'][gender][status] = 0
-    
-    # Count agents by age group and gender
-    for agent in agents:
-        age_group = get_age_group(agent['age'])
-        gender = agent['gender']
-        status = agent['status']
-        
-        # Update age group stats
-        stats['ageGroups'][age_group][status] += 1
+def count_infected_nearby(agents, radius):
+    """Count the infected agents within radius of each susceptible agent, 0 for all other agents"""
+    counts = np.zeros(len(agents), dtype=np.int32)
+    infected = agents.status == INFECTED
+    susceptible = np.flatnonzero(agents.status == SUSCEPTIBLE)
+    if infected.any() and len(susceptible):
+        xy = np.column_stack((agents.x, agents.y))
+        counts[susceptible] = cKDTree(xy[infected]).query_ball_point(xy[susceptible], r=radius, return_length=True)
+    return counts
+
+@njit(parallel=True, cache=True, fastmath=True)
+def _step_agents(status, death_mult, infection_mult, infection_day, outcome_day, infected_nearby, current_day,
+                 recovery_time, fatality_rate, transmission_prob):
+    """Advance every agent by one day and return (new_infections, new_recoveries, new_deaths)"""
+    new_infections = 0
+    new_recoveries = 0
+    new_deaths = 0
+    
+    for i in prange(status.shape[0]):
+        if status[i] == INFECTED:
+            # Determine if agent recovers or dies
+            if current_day - infection_day[i] >= recovery_time:
+                if np.random.random() < fatality_rate * death_mult[i]:
+                    status[i] = DECEASED
+                    new_deaths += 1
+                else:
+                    status[i] = RECOVERED
+                    new_recoveries += 1
+                outcome_day[i] = current_day
         
-        # Update gender stats
-        stats['genderDistribution'][gender][status] += 1
+        elif status[i] == SUSCEPTIBLE and infected_nearby[i] > 0:
+            # Every infected agent nearby gets an independent chance to transmit: 1 - (1 - p) ** n,
+            # computed via log1p/expm1 because fastmath lowers an integer power to an unlinkable powi
+            log_escape = np.log1p(-transmission_prob * infection_mult[i])
+            if np.random.random() < -np.expm1(infected_nearby[i] * log_escape):
+                status[i] = INFECTED
+                infection_day[i] = current_day
+                new_infections += 1
+    
+    return new_infections, new_recoveries, new_deaths
+
+class GPUAgents:
+    """Device copies of a population's arrays, uploaded once and stepped on the GPU"""
+
+    def __init__(self, simulation):
+        agents = simulation['agents']
+        self.population_id = simulation['population_id']
+        self.day = simulation['current_day'] - 1  # Last day stepped, so the copies match the host
+        self.status = cp.asarray(agents.status)
+        self.death_mult = cp.asarray(agents.death_mult)
+        self.infection_mult = cp.asarray(agents.infection_mult)
+        self.infection_day = cp.asarray(agents.infection_day)
+
+# Device copies of large populations stepped by this process, by simulation id, least recently used first
+gpu_populations = OrderedDict()
+gpu_populations_lock = threading.Lock()  # Request threads step different simulations concurrently
+MAX_GPU_POPULATIONS = 2
+
+def _step_agents_gpu(simulation, infected_nearby, current_day, recovery_time, fatality_rate, transmission_prob):
+    """Advance every agent by one day on the GPU
+    
+    Only the agents whose status changed are copied back into the host arrays. Returns
+    (new_infections, new_recoveries, new_deaths, changed, old_status, status_counts), where
+    old_status holds the previous status of each changed agent.
+    """
+    simulation_id = simulation['id']
+    agents = simulation['agents']
+    with gpu_populations_lock:
+        gpu = gpu_populations.get(simulation_id)
+    # Re-upload a new or reset population, or one another worker has stepped since
+    if gpu is None or gpu.population_id != simulation['population_id'] or gpu.day != current_day - 1:
+        gpu = GPUAgents(simulation)
+    with gpu_populations_lock:
+        gpu_populations[simulation_id] = gpu
+        gpu_populations.move_to_end(simulation_id)
+        while len(gpu_populations) > MAX_GPU_POPULATIONS:
+            gpu_populations.popitem(last=False)
+    
+    # Upload only the susceptible agents with infected neighbours
+    nearby_idx = np.flatnonzero(infected_nearby)
+    nearby = cp.zeros(len(agents), dtype=cp.int32)
+    nearby[cp.asarray(nearby_idx)] = cp.asarray(infected_nearby[nearby_idx])
+    
+    # Infected and susceptible agents are disjoint, so one draw per agent serves both outcomes
+    draw = cp.random.random(len(agents), dtype=cp.float32)
+    resolved = (gpu.status == INFECTED) & (current_day - gpu.infection_day >= recovery_time)
+    died = resolved & (draw < fatality_rate * gpu.death_mult)
+    infected = ((gpu.status == SUSCEPTIBLE) & (nearby > 0)
+                & (draw < 1 - (1 - transmission_prob * gpu.infection_mult) ** nearby))
+    gpu.status[died] = DECEASED
+    gpu.status[resolved & ~died] = RECOVERED
+    gpu.status[infected] = INFECTED
+    gpu.infection_day[infected] = current_day
+    gpu.day = current_day
+    
+    changed = cp.flatnonzero(resolved | infected)
+    new_status = gpu.status[changed].get()
+    changed = changed.get()
+    agents.status[changed] = new_status
+    agents.infection_day[changed[new_status == INFECTED]] = current_day
+    agents.outcome_day[changed[new_status != INFECTED]] = current_day
+    
+    # Newly infected agents were susceptible and everyone else who changed was infected
+    old_status = np.where(new_status == INFECTED, SUSCEPTIBLE, INFECTED).astype(agents.status.dtype)
+    counts = np.bincount(new_status, minlength=len(STATUS_NAMES))
+    status_counts = cp.bincount(gpu.status, minlength=len(STATUS_NAMES)).get()
+    return int(counts[INFECTED]), int(counts[RECOVERED]), int(counts[DECEASED]), changed, old_status, status_counts
+
+def record_history(history, time_step):
+    """Write the aggregates of a time step into its day's row of the history array"""
+    stats = time_step['stats']
+    history[time_step['day']] = (
+        time_step['day'], time_step['newInfections'], time_step['newRecoveries'], time_step['newDeaths'],
+        stats['susceptible'], stats['exposed'], stats['infected'], stats['recovered'], stats['deceased'],
+        time_step['r0']
+    )
+
+def apply_transitions(agents, stats, changed, old_status):
+    """Move the changed agents from their old status (one per changed agent) to their current one in the age and gender statistics"""
+    for group_idx, groups in ((_AGE_LUT[agents.age[changed]], stats['ageGroups']),
+                              (agents.gender[changed], [stats['genderDistribution'][name] for name in GENDER_NAMES])):
+        # Group x status histogram of the changes
+        delta = np.zeros((len(groups), len(STATUS_NAMES)), dtype=np.int64)
+        np.add.at(delta, (group_idx, old_status), -1)
+        np.add.at(delta, (group_idx, agents.status[changed]), 1)
+        for group, row in zip(groups, delta.tolist()):
+            for status, change in zip(STATUS_NAMES, row):
+                group[status] += change
+
+def warm_up_kernels():
+    """Compile the step kernel, or load it from Numba's cache, before the first request needs it"""
+    agents = generate_initial_agents({'populationSize': 1, 'initialInfected': 0})
+    rates = calculate_rates({})
+    _step_agents(agents.status, agents.death_mult, agents.infection_mult, agents.infection_day, agents.outcome_day,
+                 np.zeros(1, dtype=np.int32), 0, rates['recovery_time'], rates['fatality_rate'],
+                 rates['transmission_prob'])
 
 if __name__ == '__main__':
+    warm_up_kernels()
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,37 @@
+"""
+Gunicorn settings for serving the simulation backend
+
+Run from this directory with: gunicorn -c gunicorn.conf.py app:app
+"""
+
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+
+# Threaded workers keep serving other requests while one is busy stepping or encoding a simulation
+worker_class = 'gthread'
+threads = 5
+
+# Worker threads launch the parallel Numba kernel concurrently, which the workqueue layer
+# doesn't support; 'threadsafe' picks TBB or OpenMP instead. Fork safety isn't needed since
+# the master never runs the kernel. Set here so it applies before the preloaded app imports Numba.
+os.environ.setdefault('NUMBA_THREADING_LAYER', 'threadsafe')
+
+# Without REDIS_URL simulations live in each worker's memory, so a single worker is the
+# default; set GUNICORN_WORKERS=auto (2 * CPUs + 1) when simulations are stored in Redis
+# (with SHARED_MEMORY set too, workers share agent arrays instead of copying them through Redis)
+workers = os.environ.get('GUNICORN_WORKERS', '1')
+workers = 2 * multiprocessing.cpu_count() + 1 if workers == 'auto' else int(workers)
+
+# Import the app once in the master so workers fork with NumPy and Numba already loaded
+preload_app = True
+
+def post_fork(server, worker):
+    """Reseed the worker's generator and compile the step kernel, or load it from Numba's cache, before it serves requests"""
+    import numpy as np
+    import app
+    # Forked workers inherit the master's generator state, so reseed it or they'd draw identical populations
+    app.rng = np.random.Generator(np.random.SFC64())
+    # Done per worker rather than in the master, which must not launch Numba's threads before forking
+    app.warm_up_kernels()